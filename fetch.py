@@ -1,15 +1,19 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, InsertOne, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
 import time
+import random
 import os
 import sys
 import logging
 import yaml
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Semaphore
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from queue import Queue
+from threading import Thread
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +25,81 @@ logging.basicConfig(
     ]
 )
 
+# MongoDB error code for a duplicate key
+DUPLICATE_KEY_ERROR = 11000
+
+# Maximum number of writes sent to MongoDB in a single bulk_write call
+BULK_WRITE_BATCH_SIZE = 1000
+
+# NASA POWER daily point endpoint
+POWER_API_URL = (
+    'https://power.larc.nasa.gov/api/temporal/daily/point?'
+    'parameters={parameters}&community=AG&latitude={latitude}'
+    '&longitude={longitude}&start={start}&end={end}&format=JSON'
+)
+
+# Compound index used for per-county date lookups and upserts
+WEATHER_INDEX = [('fips_code', ASCENDING), ('date', ASCENDING)]
+
+# County fields needed to build API requests and weather records
+COUNTY_PROJECTION = {'_id': 0, 'fips_code': 1, 'county_name': 1, 'state_name': 1, 'latitude': 1, 'longitude': 1}
+
+# Longest server-requested Retry-After delay (in seconds) that will be honored
+MAX_RETRY_AFTER = 60
+
+_exponential_backoff = wait_exponential(multiplier=1, min=4, max=10)
+
+
+def is_retryable_error(exception):
+    # Retry connection problems, truncated or garbled bodies, throttling (429) and server errors;
+    # other 4xx are not recoverable
+    if isinstance(exception, orjson.JSONDecodeError):
+        return True
+    if isinstance(exception, requests.exceptions.HTTPError):
+        response = exception.response
+        return response is None or response.status_code == 429 or response.status_code >= 500
+    return isinstance(exception, requests.exceptions.RequestException)
+
+
+def wait_retry_after(retry_state):
+    # Honor the server's Retry-After hint when throttled, otherwise back off exponentially with jitter
+    response = getattr(retry_state.outcome.exception(), 'response', None)
+    if response is not None and response.status_code in (429, 503):
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), MAX_RETRY_AFTER)
+    delay = _exponential_backoff(retry_state)
+    return delay + random.uniform(0, 0.5) * delay
+
+
+def parse_yyyymmdd(date_str):
+    # Much faster than datetime.strptime(date_str, '%Y%m%d') for this fixed format
+    return datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8]))
+
+
+def build_records(parameters_data, parameters, county):
+    # Turn a NASA POWER parameter payload into one weather record per date
+    dates = parameters_data[next(iter(parameters_data))].keys()
+
+    # Look up each parameter's series once instead of once per date
+    cached_params = [(param.lower(), parameters_data.get(param) or {}) for param in parameters]
+
+    records = []
+    for date_str in dates:
+        record = {
+            'county_name': county['county_name'],
+            'state_name': county['state_name'],
+            'fips_code': county['fips_code'],
+            'latitude': county['latitude'],
+            'longitude': county['longitude'],
+            'date': parse_yyyymmdd(date_str)
+        }
+        # Add parameters to the record
+        for param_name, param_data in cached_params:
+            record[param_name] = param_data.get(date_str)
+        records.append(record)
+    return records
+
 
 class WeatherDataFetcher:
     def __init__(self, config):
@@ -30,10 +109,18 @@ class WeatherDataFetcher:
             raise ValueError("MongoDB URI not provided. Set the 'MONGODB_URI' environment variable or 'mongodb_uri' in config.yaml")
 
         self.re_fetch_days = config.get('re_fetch_days', 7)
+        self.skip_if_current = config.get('skip_if_current', False)
+        self.unacknowledged_writes = config.get('unacknowledged_writes', False)
         self.test_mode = config.get('test_mode', False)
         self.test_counties = config.get('test_counties', [])
         self.parameters = config.get('parameters', [])
         self.max_workers = config.get('max_workers', 5)
+        if not isinstance(self.max_workers, int) or self.max_workers < 1:
+            raise ValueError(f"max_workers must be a positive integer, got {self.max_workers!r}")
+        self.http_cache = config.get('http_cache')
+        # Fill in the parameter list once; only location and dates vary per county
+        self.api_url_template = POWER_API_URL.replace('{parameters}', ','.join(self.parameters))
+        self.set_fetch_window()
 
         # Set up MongoDB client
         self.client = MongoClient(self.mongodb_uri)
@@ -43,146 +130,222 @@ class WeatherDataFetcher:
         self.weather_collection = self.weather_db['weather_data']
 
         # Create indexes for optimization
-        self.weather_collection.create_index([('fips_code', ASCENDING), ('date', ASCENDING)])
+        self.weather_collection.create_index(WEATHER_INDEX)
 
-        # Set up a semaphore for limiting concurrent API calls
-        self.semaphore = Semaphore(self.max_workers)
+        # Writes are idempotent, so backfills may optionally skip waiting for acknowledgement
+        if self.unacknowledged_writes:
+            self.weather_write_collection = self.weather_collection.with_options(write_concern=WriteConcern(w=0))
+        else:
+            self.weather_write_collection = self.weather_collection
 
-    def get_latest_date_for_county(self, county):
-        county_filter = {
-            'fips_code': county['fips_code']
-        }
-        latest_record = self.weather_collection.find_one(county_filter, sort=[('date', -1)])
-        if latest_record:
-            return latest_record['date']
+        # Set up a pooled HTTP session so connections are reused across counties
+        if self.http_cache:
+            # Cache API responses on disk so reruns within a day don't hit the API again.
+            # requests-cache is only needed when caching is enabled.
+            from requests_cache import CachedSession
+            self.session = CachedSession(self.http_cache, backend='sqlite', expire_after=timedelta(days=1))
         else:
-            return None
+            self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers, max_retries=0)
+        self.session.mount('https://', adapter)
+
+    def set_fetch_window(self):
+        # Compute the fetch window once rather than once per county
+        today = datetime.today().date()
+        self.five_years_ago = today - timedelta(days=5*365)
+        # Set end_date to yesterday
+        self.end_date = today - timedelta(days=1)
+
+    def get_latest_dates(self, fips_codes=None):
+        # Fetch the latest stored date for every county in a single aggregation.
+        # Sorting on the (fips_code, date) index lets $group use a DISTINCT_SCAN.
+        pipeline = [
+            {'$sort': {'fips_code': -1, 'date': -1}},
+            {'$group': {'_id': '$fips_code', 'latest': {'$first': '$date'}}}
+        ]
+        if fips_codes is not None:
+            pipeline.insert(0, {'$match': {'fips_code': {'$in': fips_codes}}})
+        cursor = self.weather_collection.aggregate(pipeline, hint=WEATHER_INDEX)
+        return {doc['_id']: doc['latest'] for doc in cursor}
 
     @retry(
         stop=stop_after_attempt(5),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type(requests.exceptions.RequestException),
+        wait=wait_retry_after,
+        retry=retry_if_exception(is_retryable_error),
         reraise=True
     )
     def fetch_api_data(self, api_url):
-        response = requests.get(api_url)
+        response = self.session.get(api_url, timeout=(5, 30))
         response.raise_for_status()
-        return response.json()
-
-    def fetch_and_store_data(self, county):
-        with self.semaphore:
-            county_name = county.get('county_name')
-            state_name = county.get('state_name')
-            fips_code = county.get('fips_code')
-            latitude = county.get('latitude')
-            longitude = county.get('longitude')
-
-            # Ensure all required fields are present
-            if not all([county_name, state_name, fips_code, latitude, longitude]):
-                logging.warning(f"Missing data for county: {county}")
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            # A bad body is cached like any 200, so evict it before retrying or rerunning
+            if self.http_cache:
+                self.session.cache.delete(urls=[api_url])
+            raise
+
+    def fetch_and_store_data(self, county, latest_by_fips):
+        county_name = county.get('county_name')
+        state_name = county.get('state_name')
+        fips_code = county.get('fips_code')
+        latitude = county.get('latitude')
+        longitude = county.get('longitude')
+
+        # Ensure all required fields are present
+        if not all([county_name, state_name, fips_code, latitude, longitude]):
+            logging.warning(f"Missing data for county: {county}")
+            return
+
+        try:
+            # Get the latest date for this county from MongoDB
+            latest_date_in_db = latest_by_fips.get(fips_code)
+            if latest_date_in_db:
+                # Re-fetch data for the past 're_fetch_days' days to check for updates
+                start_date_dt = (latest_date_in_db - timedelta(days=self.re_fetch_days)).date()
+                # Ensure start_date_dt is not before 5 years ago
+                start_date_dt = max(start_date_dt, self.five_years_ago)
+            else:
+                # If no data in DB, start from 5 years ago
+                start_date_dt = self.five_years_ago
+
+            end_date_dt = self.end_date
+
+            # Skip the API call entirely when yesterday is already stored and no re-fetch is wanted
+            if latest_date_in_db and latest_date_in_db.date() >= end_date_dt and (self.skip_if_current or not self.re_fetch_days):
+                logging.info(f"Data already current for {county_name}, {state_name}")
                 return
 
+            # Ensure start_date_dt is not after end_date_dt
+            if start_date_dt > end_date_dt:
+                logging.info(f"No new data to fetch for {county_name}, {state_name}")
+                return
+
+            # Convert dates to strings in 'YYYYMMDD' format
+            start_date_str = start_date_dt.strftime('%Y%m%d')
+            end_date_str = end_date_dt.strftime('%Y%m%d')
+
+            # Build API URL
+            api_url = self.api_url_template.format(
+                latitude=latitude, longitude=longitude, start=start_date_str, end=end_date_str
+            )
+
+            data = self.fetch_api_data(api_url)
+
+            # Check for data availability
+            if 'properties' in data and 'parameter' in data['properties']:
+                parameters_data = data['properties']['parameter']
+                records = build_records(parameters_data, self.parameters, county)
+
+                ops = []
+                for record in records:
+                    if latest_date_in_db and record['date'] <= latest_date_in_db:
+                        # Dates in the re-fetch window may already be stored, so upsert them
+                        ops.append(UpdateOne({'fips_code': fips_code, 'date': record['date']}, {'$set': record}, upsert=True))
+                    else:
+                        # New dates are plain inserts with a deterministic _id, so a repeat is rejected as a duplicate
+                        record['_id'] = f"{fips_code}_{record['date']:%Y%m%d}"
+                        ops.append(InsertOne(record))
+
+                self.write_records(ops)
+                logging.info(f"Updated data for {county_name}, {state_name}")
+            else:
+                logging.warning(f"No data available for {county_name}, {state_name}")
+
+        except requests.exceptions.HTTPError as http_err:
+            logging.error(f"HTTP error occurred for {county_name}, {state_name}: {http_err}")
+        except Exception as err:
+            logging.exception(f"An unexpected error occurred for {county_name}, {state_name}")
+
+    def write_records(self, ops):
+        # Write in batches instead of one round-trip per date
+        for i in range(0, len(ops), BULK_WRITE_BATCH_SIZE):
+            batch = ops[i:i + BULK_WRITE_BATCH_SIZE]
             try:
-                # Get the latest date for this county from MongoDB
-                latest_date_in_db = self.get_latest_date_for_county(county)
-                if latest_date_in_db:
-                    # Re-fetch data for the past 're_fetch_days' days to check for updates
-                    start_date_dt = (latest_date_in_db - timedelta(days=self.re_fetch_days)).date()
-                    # Ensure start_date_dt is not before 5 years ago
-                    five_years_ago = datetime.today().date() - timedelta(days=5*365)
-                    start_date_dt = max(start_date_dt, five_years_ago)
-                else:
-                    # If no data in DB, start from 5 years ago
-                    start_date_dt = datetime.today().date() - timedelta(days=5*365)
-
-                # Set end_date to yesterday
-                end_date_dt = datetime.today().date() - timedelta(days=1)
-
-                # Ensure start_date_dt is not after end_date_dt
-                if start_date_dt > end_date_dt:
-                    logging.info(f"No new data to fetch for {county_name}, {state_name}")
-                    return
-
-                # Convert dates to strings in 'YYYYMMDD' format
-                start_date_str = start_date_dt.strftime('%Y%m%d')
-                end_date_str = end_date_dt.strftime('%Y%m%d')
-
-                # Build API URL
-                parameters_str = ','.join(self.parameters)
-                api_url = (
-                    f'https://power.larc.nasa.gov/api/temporal/daily/point?'
-                    f'parameters={parameters_str}&community=AG&latitude={latitude}'
-                    f'&longitude={longitude}&start={start_date_str}&end={end_date_str}&format=JSON'
-                )
-
-                data = self.fetch_api_data(api_url)
-
-                # Check for data availability
-                if 'properties' in data and 'parameter' in data['properties']:
-                    parameters_data = data['properties']['parameter']
-                    dates = parameters_data[next(iter(parameters_data))].keys()
-
-                    for date_str in dates:
-                        date_dt = datetime.strptime(date_str, '%Y%m%d')
-                        record = {
-                            'county_name': county_name,
-                            'state_name': state_name,
-                            'fips_code': fips_code,
-                            'latitude': latitude,
-                            'longitude': longitude,
-                            'date': date_dt
-                        }
-                        # Add parameters to the record
-                        for param in self.parameters:
-                            param_data = parameters_data.get(param)
-                            if param_data and date_str in param_data:
-                                record[param.lower()] = param_data[date_str]
-                            else:
-                                record[param.lower()] = None
-
-                        # Build a filter to check if record exists
-                        filter_query = {
-                            'fips_code': fips_code,
-                            'date': date_dt
-                        }
-                        # Upsert the record
-                        self.weather_collection.update_one(
-                            filter_query,
-                            {'$set': record},
-                            upsert=True
-                        )
-                    logging.info(f"Updated data for {county_name}, {state_name}")
-                else:
-                    logging.warning(f"No data available for {county_name}, {state_name}")
-
-            except requests.exceptions.HTTPError as http_err:
-                logging.error(f"HTTP error occurred for {county_name}, {state_name}: {http_err}")
-            except Exception as err:
-                logging.exception(f"An unexpected error occurred for {county_name}, {state_name}")
+                result = self.weather_write_collection.bulk_write(batch, ordered=False)
+                # Unacknowledged writes return no counts
+                if result.acknowledged:
+                    logging.debug(
+                        f"Bulk write: {result.inserted_count} inserted, {result.upserted_count} upserted, "
+                        f"{result.modified_count} modified"
+                    )
+            except BulkWriteError as bwe:
+                # Duplicate inserts mean the record is already stored; anything else is a real failure
+                details = bwe.details
+                if details.get('writeConcernErrors') or any(
+                    error['code'] != DUPLICATE_KEY_ERROR for error in details.get('writeErrors', [])
+                ):
+                    raise
+
+    def _process_queue(self, county_queue, latest_by_fips):
+        # Worker loop: process counties until a None sentinel is received
+        while True:
+            county = county_queue.get()
+            if county is None:
+                break
+            try:
+                self.fetch_and_store_data(county, latest_by_fips)
+            except Exception as e:
+                logging.exception(f"Error processing county: {e}")
 
     def run(self):
+        # Refresh the fetch window in case the fetcher was created on an earlier day
+        self.set_fetch_window()
+
         try:
             if self.test_mode:
-                counties_cursor = self.county_collection.find({'fips_code': {'$in': self.test_counties}})
+                county_filter = {'fips_code': {'$in': self.test_counties}}
+                latest_by_fips = self.get_latest_dates(self.test_counties)
             else:
-                counties_cursor = self.county_collection.find({})
+                county_filter = {}
+                latest_by_fips = self.get_latest_dates()
 
-            counties = list(counties_cursor)
-            logging.info(f"Number of counties to process: {len(counties)}")  # Add this line
+            # Order counties by half-degree grid cell so neighbouring locations are requested
+            # back to back, and fetch only the fields that are used
+            counties_cursor = self.county_collection.aggregate([
+                {'$match': county_filter},
+                # Non-numeric coordinates convert to null, so those counties sort first and are
+                # rejected individually by fetch_and_store_data instead of failing the query
+                {'$addFields': {
+                    'lat_cell': {'$round': [{'$multiply': [
+                        {'$convert': {'input': '$latitude', 'to': 'double', 'onError': None, 'onNull': None}}, 2
+                    ]}, 0]},
+                    'lon_cell': {'$round': [{'$multiply': [
+                        {'$convert': {'input': '$longitude', 'to': 'double', 'onError': None, 'onNull': None}}, 2
+                    ]}, 0]}
+                }},
+                {'$sort': {'lat_cell': 1, 'lon_cell': 1}},
+                {'$project': COUNTY_PROJECTION}
+            ], batchSize=500)
 
-            if not counties:
-                logging.warning("No counties found to process. Exiting script.")
-                return
+            # Feed counties to the workers as the cursor yields them; the bounded queue caps memory use
+            county_queue = Queue(maxsize=2 * self.max_workers)
+            workers = [
+                Thread(target=self._process_queue, args=(county_queue, latest_by_fips))
+                for _ in range(self.max_workers)
+            ]
+            for worker in workers:
+                worker.start()
+
+            county_count = 0
+            try:
+                for county in counties_cursor:
+                    county_count += 1
+                    county_queue.put(county)
+            finally:
+                # Send one sentinel per worker so each exits once the queue is drained
+                for _ in workers:
+                    county_queue.put(None)
+                for worker in workers:
+                    worker.join()
+
+            logging.info(f"Number of counties queued: {county_count}")
 
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                futures = [executor.submit(self.fetch_and_store_data, county) for county in counties]
-                for future in as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        logging.exception(f"Error processing county: {e}")
+            if not county_count:
+                logging.warning("No counties found to process. Exiting script.")
         finally:
-            # Ensure MongoDB client is closed
+            # Ensure HTTP session and MongoDB client are closed
+            self.session.close()
             self.client.close()
             logging.info("MongoDB connection closed.")
 
@@ -193,6 +356,9 @@ def main():
     parser.add_argument('--config', type=str, default='config.yaml', help='Path to the configuration file')
     parser.add_argument('--test', action='store_true', help='Run in test mode')
     parser.add_argument('--re-fetch-days', type=int, help='Number of days to re-fetch for updates')
+    parser.add_argument('--skip-if-current', action='store_true', help='Skip counties whose data is already up to date')
+    parser.add_argument('--unacknowledged-writes', action='store_true', help='Write weather data without waiting for acknowledgement')
+    parser.add_argument('--http-cache', type=str, help='Path to a SQLite file for caching API responses')
     parser.add_argument('--max-workers', type=int, help='Maximum number of worker threads')
     args = parser.parse_args()
 
@@ -205,6 +371,12 @@ def main():
         config['test_mode'] = True
     if args.re_fetch_days is not None:
         config['re_fetch_days'] = args.re_fetch_days
+    if args.skip_if_current:
+        config['skip_if_current'] = True
+    if args.unacknowledged_writes:
+        config['unacknowledged_writes'] = True
+    if args.http_cache is not None:
+        config['http_cache'] = args.http_cache
     if args.max_workers is not None:
         config['max_workers'] = args.max_workers
 